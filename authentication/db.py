@@ -1,5 +1,13 @@
 import os
 from dotenv import load_dotenv
+
+# Load environment variables before importing motor: Motor sizes the thread
+# pool that runs every PyMongo call from MOTOR_MAX_WORKERS at import time, so
+# a value set in .env only takes effect if it is loaded first. It caps how many
+# operations can be in flight at once - keep it >= MONGO_MAX_POOL_SIZE, or the
+# extra pool connections can never be used (Motor's default is 5 x CPU count).
+load_dotenv()
+
 from motor.motor_asyncio import AsyncIOMotorClient
 from beanie import init_beanie
 from models import (
@@ -10,16 +18,20 @@ from models import (
     UserPreferences,
 )
 
-# Load environment variables
-load_dotenv()
-
 # Fetch MongoDB URL
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL not set in the environment variables.")
 
 # MongoDB client setup
-client = AsyncIOMotorClient(DATABASE_URL)
+client = AsyncIOMotorClient(
+    DATABASE_URL,
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 20)),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 5)),
+    serverSelectionTimeoutMS=3000,
+    retryWrites=True,
+    tz_aware=True,
+)
 
 # If DATABASE_URL already includes a default DB, you can use:
 # db = client.get_default_database()
@@ -40,3 +52,5 @@ async def init_db():
             UserPreferences,
         ],
     )
+    # Connect and authenticate now rather than on the first request
+    await client.admin.command("ping")
@@ -1,36 +1,72 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
-from typing import List, Optional
-from uuid import UUID
+from typing import Any, Optional
+from datetime import datetime, timezone
 from contextlib import asynccontextmanager
 import os
+import time
+import hashlib
+import queue
+import orjson
+import logging
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 load_dotenv()
 
+# Logging - records are queued and written by a background thread,
+# so request handlers never wait on the stdout lock
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[QueueHandler(log_queue)],
+)
+
 from db import init_db
-from auth import fastapi_users, auth_backend, current_active_user, oauth, get_user_manager
+from auth import fastapi_users, auth_backend, current_active_user, current_user_oid, oauth, get_user_manager
 from models import (
-    UserCreate, UserRead, UserUpdate, UserDB,
-    SessionCreate, SessionRead, MediaFileRead, MediaFile 
+    UserCreate, UserRead, UserUpdate, UserDB, UserFullRead, UserPreferencesRead,
+    SessionCreate, SessionRead, SessionPage, MediaFilePage, MediaFile
 )
 from services.storage_service import StorageService
 from services.user_service import UserService
 from beanie import PydanticObjectId
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
 
 # Lifespan event handler
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    log_listener.start()
     await init_db()
+    await storage_service.start()
     yield
-    # Shutdown (if you need any cleanup)
-    pass
+    # Shutdown
+    await storage_service.close()
+    log_listener.stop()
+
+# Route return values are already JSON-safe by the time render runs (FastAPI
+# applies jsonable_encoder / the response model first), so this only fires for
+# content passed straight to MongoJSONResponse(...) by hand.
+def orjson_default(value: Any) -> str:
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class MongoJSONResponse(ORJSONResponse):
+    """orjson-backed default response class"""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
 
 app = FastAPI(
     title="Interview AI Platform", 
     version="1.0.0",
+    default_response_class=MongoJSONResponse,
     lifespan=lifespan
 )
 
@@ -43,14 +79,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Static files for local storage
-if not os.path.exists("storage"):
-    os.makedirs("storage")
-app.mount("/files", StaticFiles(directory="storage"), name="files")
-
 # Initialize services
 storage_service = StorageService()
 
+# Conditional GET helpers
+def make_etag(*parts) -> str:
+    """Weak ETag built from the values that identify a response's content"""
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+def timestamp_ms(value: datetime) -> int:
+    # Mongo stores datetimes at millisecond precision, always in UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+def not_modified(request: Request, etag: str) -> bool:
+    """Check whether the client's If-None-Match already covers etag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(",")]
+
 # Auth routes - ONLY include JWT auth route, not the register/users routes
 app.include_router(
     fastapi_users.get_auth_router(auth_backend),
@@ -63,20 +114,38 @@ app.include_router(
 async def register(user_create: UserCreate, user_manager=Depends(get_user_manager)):
     """Custom registration endpoint that properly handles ObjectId conversion"""
     try:
+        started = time.perf_counter()
         user = await user_manager.create(user_create)
-        # Convert to dict and handle ObjectId conversion
-        user_dict = user.dict()
-        user_dict['id'] = str(user.id)  # Convert ObjectId to string
-        return UserRead(**user_dict)
+        logger.debug("User create took %.1f ms (includes password hashing)", (time.perf_counter() - started) * 1000)
+        # Read straight from the document; UserRead converts the ObjectId to string
+        return UserRead.model_validate(user)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/users/me", response_model=UserRead, tags=["users"])
-async def get_current_user(current_user: UserDB = Depends(current_active_user)):
-    """Get current user with proper ObjectId conversion"""
-    user_dict = current_user.dict()
-    user_dict['id'] = str(current_user.id)
-    return UserRead(**user_dict)
+async def get_current_user(
+    request: Request,
+    response: Response,
+    current_user: UserDB = Depends(current_active_user)
+):
+    """Get current user with proper ObjectId conversion, 304 if unchanged"""
+    etag = make_etag(current_user.id, timestamp_ms(current_user.updated_at))
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return UserRead.model_validate(current_user)
+
+@app.get("/users/me/full", response_model=UserFullRead, tags=["users"])
+async def get_current_user_full(user_oid: PydanticObjectId = Depends(current_user_oid)):
+    """Get current user together with their preferences in a single query"""
+    result = await UserService.get_user_with_preferences(user_oid)
+    if not result:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    user, preferences = result
+    user_read = UserFullRead.model_validate(user)
+    user_read.preferences = UserPreferencesRead.model_validate(preferences)
+    return user_read
 
 @app.patch("/users/me", response_model=UserRead, tags=["users"])
 async def update_current_user(
@@ -87,9 +156,7 @@ async def update_current_user(
     """Update current user with proper ObjectId conversion"""
     try:
         user = await user_manager.update(user_update, current_user)
-        user_dict = user.dict()
-        user_dict['id'] = str(user.id)
-        return UserRead(**user_dict)
+        return UserRead.model_validate(user)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -129,41 +196,56 @@ async def google_callback(request: Request):
 @app.post("/sessions", response_model=SessionRead)
 async def create_session(
     session_data: SessionCreate,
-    current_user: UserDB = Depends(current_active_user)
+    user_oid: PydanticObjectId = Depends(current_user_oid)
 ):
-    session = await UserService.create_user_session(PydanticObjectId(str(current_user.id)), session_data.dict())
+    session = await UserService.create_user_session(user_oid, session_data.dict())
     return session
 
-@app.get("/sessions", response_model=List[SessionRead])
-async def get_user_sessions(current_user: UserDB = Depends(current_active_user)):
-    return await UserService.get_user_sessions(PydanticObjectId(str(current_user.id)))
+@app.get("/sessions", response_model=SessionPage)
+async def get_user_sessions(
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[PydanticObjectId] = None,
+    user_oid: PydanticObjectId = Depends(current_user_oid)
+):
+    items = await UserService.get_user_sessions(user_oid, limit, cursor)
+    next_cursor = items[-1].id if len(items) == limit else None
+    return SessionPage(items=items, next_cursor=next_cursor)
 
 @app.get("/sessions/{session_id}", response_model=SessionRead)
-async def get_session(session_id: PydanticObjectId, current_user: UserDB = Depends(current_active_user)):
-    if not await UserService.user_owns_resource(PydanticObjectId(str(current_user.id)), session_id, 'session'):
+async def get_session(session_id: PydanticObjectId, user_oid: PydanticObjectId = Depends(current_user_oid)):
+    session = await UserService.get_owned_session(user_oid, session_id)
+    if not session:
         raise HTTPException(status_code=404, detail="Session not found")
-    return await UserService.get_session_by_id(session_id)
+    return session
 
 # File Upload and Management
 @app.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
     session_id: Optional[str] = None,
-    current_user: UserDB = Depends(current_active_user)
+    user_oid: PydanticObjectId = Depends(current_user_oid)
 ):
     try:
         if not storage_service.validate_file(file):
             raise HTTPException(status_code=400, detail="Invalid file type")
 
-        file_metadata = await storage_service.save_file(file, str(current_user.id), session_id)
+        # Reuse the stored copy of identical content this user already uploaded. If that record
+        # is deleted between this lookup and the insert below, the delete sees no other record
+        # on the path and removes the object, leaving the new record pointing at nothing
+        async def find_existing(digest: str) -> Optional[str]:
+            existing = await UserService.get_media_by_sha256(user_oid, digest)
+            return existing.file_path if existing else None
+
+        file_metadata = await storage_service.save_file(file, str(user_oid), session_id, find_existing)
 
         media_file = MediaFile(
-            user_id=PydanticObjectId(str(current_user.id)),
+            user_id=user_oid,
             session_id=PydanticObjectId(session_id) if session_id else None,
-            file_type='video' if file.content_type.startswith('video') else 'audio',
+            file_type='video' if file_metadata['mime_type'].startswith('video') else 'audio',
             file_path=file_metadata['file_path'],
             file_size=file_metadata['file_size'],
-            mime_type=file_metadata['mime_type']
+            mime_type=file_metadata['mime_type'],
+            sha256=file_metadata['sha256']
         )
         await media_file.insert()
 
@@ -172,26 +254,47 @@ async def upload_file(
             "message": "File uploaded successfully",
             "file_path": file_metadata['file_path']
         }
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
-@app.get("/files", response_model=List[MediaFileRead])
+@app.get("/files", response_model=MediaFilePage)
 async def get_user_files(
     session_id: Optional[PydanticObjectId] = None,
-    current_user: UserDB = Depends(current_active_user)
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[PydanticObjectId] = None,
+    user_oid: PydanticObjectId = Depends(current_user_oid)
 ):
-    return await UserService.get_user_media_files(PydanticObjectId(str(current_user.id)), session_id)
+    items = await UserService.get_user_media_files(user_oid, session_id, limit, cursor)
+    next_cursor = items[-1].id if len(items) == limit else None
+    return MediaFilePage(items=items, next_cursor=next_cursor)
 
 @app.get("/files/{file_id}")
-async def get_file(file_id: PydanticObjectId, current_user: UserDB = Depends(current_active_user)):
-    if not await UserService.user_owns_resource(PydanticObjectId(str(current_user.id)), file_id, 'media'):
+async def get_file(
+    file_id: PydanticObjectId,
+    request: Request,
+    response: Response,
+    user_oid: PydanticObjectId = Depends(current_user_oid)
+):
+    media_file = await UserService.get_owned_media(user_oid, file_id)
+    if not media_file:
         raise HTTPException(status_code=404, detail="File not found")
 
-    media_file = await MediaFile.get(file_id)
     file_url = await storage_service.get_file_url(media_file.file_path)
 
+    # Include the URL so clients never reuse an expired presigned link
+    etag = make_etag(
+        media_file.id,
+        timestamp_ms(media_file.created_at),
+        hashlib.sha256(file_url.encode()).hexdigest()[:16]
+    )
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
     return {
         "file_id": str(media_file.id),
         "file_url": file_url,
@@ -201,30 +304,37 @@ async def get_file(file_id: PydanticObjectId, current_user: UserDB = Depends(cur
     }
 
 @app.delete("/files/{file_id}")
-async def delete_file(file_id: PydanticObjectId, current_user: UserDB = Depends(current_active_user)):
-    if not await UserService.user_owns_resource(PydanticObjectId(str(current_user.id)), file_id, 'media'):
+async def delete_file(file_id: PydanticObjectId, user_oid: PydanticObjectId = Depends(current_user_oid)):
+    media_file = await UserService.get_owned_media(user_oid, file_id)
+    if not media_file:
         raise HTTPException(status_code=404, detail="File not found")
 
-    media_file = await MediaFile.get(file_id)
-    await storage_service.delete_file(media_file.file_path)
     await media_file.delete()
+    # Deduplicated uploads share one stored copy - keep it while another record points at it
+    if not await UserService.get_media_by_path(user_oid, media_file.file_path):
+        await storage_service.delete_file(media_file.file_path)
 
     return {"message": "File deleted successfully"}
 
 # User Preferences
 @app.get("/preferences")
-async def get_user_preferences(current_user: UserDB = Depends(current_active_user)):
-    return await UserService.get_user_preferences(PydanticObjectId(str(current_user.id)))
+async def get_user_preferences(user_oid: PydanticObjectId = Depends(current_user_oid)):
+    return await UserService.get_user_preferences(user_oid)
 
 @app.put("/preferences")
-async def update_user_preferences(preferences_data: dict, current_user: UserDB = Depends(current_active_user)):
-    return await UserService.update_user_preferences(PydanticObjectId(str(current_user.id)), preferences_data)
+async def update_user_preferences(preferences_data: dict, user_oid: PydanticObjectId = Depends(current_user_oid)):
+    return await UserService.update_user_preferences(user_oid, preferences_data)
 
 # Health check
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+# Static files for local storage, mounted after the API routes so /files/{file_id} is not shadowed
+if not os.path.exists("storage"):
+    os.makedirs("storage")
+app.mount("/files", StaticFiles(directory="storage"), name="files")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,13 +1,19 @@
 from uuid import UUID, uuid4
 from typing import Optional, List, Any, Dict
-from datetime import datetime
-from pydantic import EmailStr, Field, BaseModel
+from datetime import datetime, timezone
+from pydantic import EmailStr, Field, BaseModel, field_validator
 from beanie import Document, Indexed, PydanticObjectId
+from pymongo import IndexModel
 from fastapi_users.db import BeanieBaseUser
 from fastapi_users import schemas 
 from bson import ObjectId
 
 
+def utc_now() -> datetime:
+    """Timezone-aware current UTC time (datetime.utcnow is naive and deprecated)"""
+    return datetime.now(timezone.utc)
+
+
 # -------------------------
 # User Models
 # -------------------------
@@ -16,8 +22,8 @@ class UserDB(BeanieBaseUser, Document):
     google_id: Optional[str] = Field(None, unique=True)
     avatar_url: Optional[str] = None
     role: str = "interviewee" 
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
 
     class Settings:
         name = "users"
@@ -37,14 +43,15 @@ class UserSession(Document):
     session_name: str
     session_type: str
     status: str = "active"
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
     metadata: Optional[Dict[str, Any]] = None
 
     class Settings:
         name = "user_sessions"
+        # (user_id, _id) also serves plain user_id lookups
         indexes = [
-            [("user_id", 1)],
+            [("user_id", 1), ("_id", 1)],
             [("created_at", -1)],
         ]
 
@@ -61,14 +68,18 @@ class MediaFile(Document):
     file_size: Optional[int] = None
     duration: Optional[int] = None
     mime_type: Optional[str] = None
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=utc_now)
     processing_status: str = "pending"
     ai_analysis: Optional[Dict[str, Any]] = None
+    sha256: Optional[str] = None  # Content hash, used to deduplicate uploads
 
     class Settings:
         name = "media_files"
+        # Compound indexes lead with user_id, so they also serve plain user_id lookups
         indexes = [
-            [("user_id", 1)],
+            [("user_id", 1), ("session_id", 1), ("_id", -1)],
+            [("user_id", 1), ("_id", 1)],
+            [("user_id", 1), ("sha256", 1)],
             [("session_id", 1)],
             [("created_at", -1)],
         ]
@@ -90,12 +101,13 @@ class LLMConversation(Document):
     context_data: Optional[Dict[str, Any]] = None
     response_metadata: Optional[Dict[str, Any]] = None
 
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=utc_now)
 
     class Settings:
         name = "llm_conversations"
+        # (user_id, _id) also serves plain user_id lookups
         indexes = [
-            [("user_id", 1)],
+            [("user_id", 1), ("_id", 1)],
             [("session_id", 1)],
             [("created_at", -1)],
         ]
@@ -115,13 +127,15 @@ class UserPreferences(Document):
     data_retention_days: int = 30
     allow_data_analysis: bool = True
     preferences_data: Optional[Dict[str, Any]] = None
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
 
     class Settings:
         name = "user_preferences"
+        # One document per user. Building this fails while duplicates exist: keep the newest
+        # document per user_id, delete the rest, restart, then drop the old user_id_1 index
         indexes = [
-            [("user_id", 1)],
+            IndexModel([("user_id", 1)], unique=True, name="user_id_unique"),
         ]
 
 
@@ -144,6 +158,32 @@ class UserRead(BaseModel):
     class Config:
         from_attributes = True
 
+    @field_validator("id", mode="before")
+    @classmethod
+    def id_to_str(cls, value: Any) -> str:
+        return str(value)
+
+class UserPreferencesRead(BaseModel):
+    id: PydanticObjectId
+    user_id: PydanticObjectId
+    preferred_duration: int
+    difficulty_level: str
+    interview_types: List[str]
+    email_notifications: bool
+    reminder_notifications: bool
+    data_retention_days: int
+    allow_data_analysis: bool
+    preferences_data: Optional[Dict[str, Any]]
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+# User together with their preferences, served from one aggregation
+class UserFullRead(UserRead):
+    preferences: Optional[UserPreferencesRead] = None
+
 class UserCreate(schemas.BaseUserCreate):
     full_name: Optional[str] = None
     role: str = "interviewee"
@@ -179,4 +219,60 @@ class MediaFileRead(BaseModel):
     mime_type: Optional[str]
     created_at: datetime
     processing_status: str
-    ai_analysis: Optional[Dict[str, Any]]
\ No newline at end of file
+    ai_analysis: Optional[Dict[str, Any]]
+
+# Projections for list endpoints - skip the free-form metadata / ai_analysis blobs
+class SessionSummary(BaseModel):
+    id: PydanticObjectId = Field(validation_alias="_id")
+    user_id: PydanticObjectId
+    session_name: str
+    session_type: str
+    status: str
+    created_at: datetime
+    updated_at: datetime
+
+    class Settings:
+        projection = {
+            "_id": 1,
+            "user_id": 1,
+            "session_name": 1,
+            "session_type": 1,
+            "status": 1,
+            "created_at": 1,
+            "updated_at": 1,
+        }
+
+class MediaFileSummary(BaseModel):
+    id: PydanticObjectId = Field(validation_alias="_id")
+    user_id: PydanticObjectId
+    session_id: Optional[PydanticObjectId] = None
+    file_type: str
+    file_path: str
+    file_size: Optional[int] = None
+    duration: Optional[int] = None
+    mime_type: Optional[str] = None
+    created_at: datetime
+    processing_status: str
+
+    class Settings:
+        projection = {
+            "_id": 1,
+            "user_id": 1,
+            "session_id": 1,
+            "file_type": 1,
+            "file_path": 1,
+            "file_size": 1,
+            "duration": 1,
+            "mime_type": 1,
+            "created_at": 1,
+            "processing_status": 1,
+        }
+
+# Keyset-paginated list responses - pass next_cursor back as ?cursor= for the next page
+class SessionPage(BaseModel):
+    items: List[SessionSummary]
+    next_cursor: Optional[PydanticObjectId] = None
+
+class MediaFilePage(BaseModel):
+    items: List[MediaFileSummary]
+    next_cursor: Optional[PydanticObjectId] = None
@@ -1,37 +1,105 @@
 import os
 import uuid
-from typing import Optional
+import hashlib
+from contextlib import AsyncExitStack
+from typing import Awaitable, Callable, Optional
 from pathlib import Path
-import boto3
+import aiofiles
+import aioboto3
+from cachetools import TTLCache
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 from fastapi import UploadFile
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Maps a SHA-256 digest to the path of an already stored copy of that content
+FindExisting = Callable[[str], Awaitable[Optional[str]]]
+
+class _AsyncUploadReader:
+    """File-like view of an UploadFile whose read() is awaited by aioboto3, keeping disk reads off the event loop"""
+    def __init__(self, file: UploadFile):
+        self._file = file
+    
+    def read(self, size: int = -1):
+        return self._file.read(size)
+
 class StorageService:
     def __init__(self):
         self.storage_type = os.getenv("STORAGE_TYPE", "local")
         self.max_file_size = int(os.getenv("MAX_FILE_SIZE", 100 * 1024 * 1024))  # 100MB
-        self.allowed_extensions = ['.mp4', '.mov', '.avi', '.mp3', '.wav', '.m4a', '.webm']
+        self.chunk_size = 1024 * 1024  # 1MB
+        # Content types accepted per extension; the first one is assumed when the client sends none
+        self._allowed_types = {
+            '.mp4': ('video/mp4', 'audio/mp4'),
+            '.mov': ('video/quicktime',),
+            '.avi': ('video/x-msvideo', 'video/avi'),
+            '.mp3': ('audio/mpeg', 'audio/mp3'),
+            '.wav': ('audio/wav', 'audio/x-wav', 'audio/wave', 'audio/vnd.wave'),
+            '.m4a': ('audio/mp4', 'audio/x-m4a', 'audio/m4a'),
+            '.webm': ('video/webm', 'audio/webm'),
+        }
+        self.allowed_extensions = list(self._allowed_types)
+        # Sent by curl and Dart's MultipartFile.fromPath when no type is given
+        self._generic_content_types = frozenset(['', 'application/octet-stream'])
         
+        self.s3_client = None
+        self._exit_stack = AsyncExitStack()
+        if self.storage_type == 's3':
+            self.bucket_name = os.getenv("AWS_BUCKET_NAME")
+            self.url_expires_in = 900  # 15 minutes
+            # Reuse signed URLs while they still have at least 5 minutes left
+            self._url_cache: TTLCache = TTLCache(maxsize=5000, ttl=600)
+            # Bound multipart memory to a few parts; 5MB is the S3 minimum part size
+            self._transfer_config = TransferConfig(
+                multipart_chunksize=5 * 1024 * 1024,
+                io_chunksize=self.chunk_size,
+                max_concurrency=2,
+                max_io_queue=2
+            )
+    
+    async def start(self):
+        """Open the async S3 client, called from the app lifespan"""
         if self.storage_type == 's3':
-            self.s3_client = boto3.client(
-                's3',
+            session = aioboto3.Session(
                 aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
                 aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
             )
-            self.bucket_name = os.getenv("AWS_BUCKET_NAME")
+            self.s3_client = await self._exit_stack.enter_async_context(session.client('s3'))
+    
+    async def close(self):
+        """Close the async S3 client"""
+        await self._exit_stack.aclose()
+        self.s3_client = None
+    
+    def resolve_content_type(self, file: UploadFile) -> Optional[str]:
+        """Return the content type to store for the file, or None if it does not match its extension"""
+        if not file.filename:
+            return None
+        allowed = self._allowed_types.get(Path(file.filename).suffix.lower())
+        if not allowed:
+            return None
+        # Ignore parameters such as "audio/webm;codecs=opus"
+        content_type = (file.content_type or '').split(';', 1)[0].strip().lower()
+        if content_type in self._generic_content_types:
+            return allowed[0]
+        return content_type if content_type in allowed else None
     
     def validate_file(self, file: UploadFile) -> bool:
-        """Validate file type and size"""
-        if not any(file.filename.lower().endswith(ext) for ext in self.allowed_extensions):
-            return False
-        return True
+        """Validate file extension and declared content type"""
+        return self.resolve_content_type(file) is not None
     
-    async def save_file(self, file: UploadFile, user_id: str, session_id: Optional[str] = None) -> dict:
-        """Save file and return metadata"""
-        if not self.validate_file(file):
+    async def save_file(
+        self,
+        file: UploadFile,
+        user_id: str,
+        session_id: Optional[str] = None,
+        find_existing: Optional[FindExisting] = None
+    ) -> dict:
+        """Save file and return metadata, reusing the copy find_existing returns for the same content"""
+        content_type = self.resolve_content_type(file)
+        if not content_type:
             raise ValueError("Invalid file type")
         
         file_id = str(uuid.uuid4())
@@ -44,52 +112,83 @@ class StorageService:
             file_path = f"users/{user_id}/uploads/{file_id}{file_extension}"
         
         if self.storage_type == 'local':
-            return await self._save_local(file, file_path)
+            return await self._save_local(file, file_path, content_type, find_existing)
         elif self.storage_type == 's3':
-            return await self._save_s3(file, file_path)
+            return await self._save_s3(file, file_path, content_type, find_existing)
         else:
             raise ValueError(f"Unsupported storage type: {self.storage_type}")
     
-    async def _save_local(self, file: UploadFile, file_path: str) -> dict:
-        """Save file locally"""
+    @staticmethod
+    async def _find_duplicate(find_existing: Optional[FindExisting], digest: str) -> Optional[str]:
+        """Path of a stored copy with the same content, if the caller knows one"""
+        return await find_existing(digest) if find_existing else None
+    
+    async def _save_local(self, file: UploadFile, file_path: str, content_type: str, find_existing: Optional[FindExisting]) -> dict:
+        """Save file locally, streaming it to disk in chunks"""
         full_path = Path("storage") / file_path
         full_path.parent.mkdir(parents=True, exist_ok=True)
         
-        content = await file.read()
-        
-        # Check file size
-        if len(content) > self.max_file_size:
-            raise ValueError(f"File too large. Max size: {self.max_file_size} bytes")
+        file_size = 0
+        sha256 = hashlib.sha256()
+        try:
+            async with aiofiles.open(full_path, "wb") as f:
+                while chunk := await file.read(self.chunk_size):
+                    file_size += len(chunk)
+                    # Check file size
+                    if file_size > self.max_file_size:
+                        raise ValueError(f"File too large. Max size: {self.max_file_size} bytes")
+                    sha256.update(chunk)
+                    await f.write(chunk)
+        except Exception:
+            full_path.unlink(missing_ok=True)
+            raise
         
-        with open(full_path, "wb") as f:
-            f.write(content)
+        digest = sha256.hexdigest()
+        stored_path = await self._find_duplicate(find_existing, digest)
+        if stored_path:
+            # Same content already stored - drop the new copy
+            full_path.unlink(missing_ok=True)
+        else:
+            stored_path = str(full_path)
         
         return {
-            'file_path': str(full_path),
-            'file_size': len(content),
-            'mime_type': file.content_type
+            'file_path': stored_path,
+            'file_size': file_size,
+            'mime_type': content_type,
+            'sha256': digest
         }
     
-    async def _save_s3(self, file: UploadFile, file_path: str) -> dict:
-        """Save file to S3"""
+    async def _save_s3(self, file: UploadFile, file_path: str, content_type: str, find_existing: Optional[FindExisting]) -> dict:
+        """Save file to S3 as a multipart upload streamed from the spooled upload"""
         try:
-            content = await file.read()
+            # Hash the spooled upload first so duplicates never reach S3
+            file_size = 0
+            sha256 = hashlib.sha256()
+            while chunk := await file.read(self.chunk_size):
+                file_size += len(chunk)
+                # Check file size
+                if file_size > self.max_file_size:
+                    raise ValueError(f"File too large. Max size: {self.max_file_size} bytes")
+                sha256.update(chunk)
             
-            # Check file size
-            if len(content) > self.max_file_size:
-                raise ValueError(f"File too large. Max size: {self.max_file_size} bytes")
-            
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=file_path,
-                Body=content,
-                ContentType=file.content_type
-            )
+            digest = sha256.hexdigest()
+            stored_path = await self._find_duplicate(find_existing, digest)
+            if not stored_path:
+                await file.seek(0)
+                await self.s3_client.upload_fileobj(
+                    _AsyncUploadReader(file),
+                    self.bucket_name,
+                    file_path,
+                    ExtraArgs={'ContentType': content_type},
+                    Config=self._transfer_config
+                )
+                stored_path = file_path
             
             return {
-                'file_path': file_path,
-                'file_size': len(content),
-                'mime_type': file.content_type
+                'file_path': stored_path,
+                'file_size': file_size,
+                'mime_type': content_type,
+                'sha256': digest
             }
         except ClientError as e:
             raise Exception(f"Failed to upload to S3: {e}")
@@ -97,9 +196,18 @@ class StorageService:
     async def get_file_url(self, file_path: str) -> str:
         """Get file URL for access"""
         if self.storage_type == 'local':
-            return f"/files/{file_path}"
+            # Local paths are stored under storage/, which is what /files serves
+            return f"/files/{Path(file_path).relative_to('storage').as_posix()}"
         elif self.storage_type == 's3':
-            return f"https://{self.bucket_name}.s3.amazonaws.com/{file_path}"
+            url = self._url_cache.get(file_path)
+            if url is None:
+                url = await self.s3_client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': self.bucket_name, 'Key': file_path},
+                    ExpiresIn=self.url_expires_in
+                )
+                self._url_cache[file_path] = url
+            return url
     
     async def delete_file(self, file_path: str) -> bool:
         """Delete file from storage"""
@@ -110,8 +218,9 @@ class StorageService:
             except OSError:
                 return False
         elif self.storage_type == 's3':
+            self._url_cache.pop(file_path, None)
             try:
-                self.s3_client.delete_object(
+                await self.s3_client.delete_object(
                     Bucket=self.bucket_name,
                     Key=file_path
                 )
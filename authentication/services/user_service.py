@@ -1,25 +1,41 @@
-from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from uuid import UUID
-from models import UserDB, UserSession, MediaFile, LLMConversation, UserPreferences
+from models import (
+    UserDB, UserSession, MediaFile, LLMConversation, UserPreferences,
+    SessionSummary, MediaFileSummary, utc_now
+)
 from beanie import PydanticObjectId
+from beanie.odm.utils.dump import get_dict
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 class UserService:
     @staticmethod
-    async def get_user_sessions(user_id: PydanticObjectId) -> List[UserSession]:
-        """Get all sessions for a specific user"""
-        return await UserSession.find(UserSession.user_id == user_id).to_list()
+    async def get_user_sessions(
+        user_id: PydanticObjectId,
+        limit: int = 50,
+        cursor: Optional[PydanticObjectId] = None
+    ) -> List[SessionSummary]:
+        """Get a page of sessions for a specific user, newest first, starting after cursor"""
+        filters = [UserSession.user_id == user_id]
+        if cursor:
+            filters.append(UserSession.id < cursor)
+        return await UserSession.find(*filters).sort(-UserSession.id).limit(limit).project(SessionSummary).to_list()
     
     @staticmethod
-    async def get_user_media_files(user_id: PydanticObjectId, session_id: Optional[PydanticObjectId] = None) -> List[MediaFile]:
-        """Get media files for user, optionally filtered by session"""
+    async def get_user_media_files(
+        user_id: PydanticObjectId,
+        session_id: Optional[PydanticObjectId] = None,
+        limit: int = 50,
+        cursor: Optional[PydanticObjectId] = None
+    ) -> List[MediaFileSummary]:
+        """Get a page of media files for user, optionally filtered by session, newest first"""
+        filters = [MediaFile.user_id == user_id]
         if session_id:
-            return await MediaFile.find(
-                MediaFile.user_id == user_id,
-                MediaFile.session_id == session_id
-            ).to_list()
-        else:
-            return await MediaFile.find(MediaFile.user_id == user_id).to_list()
+            filters.append(MediaFile.session_id == session_id)
+        if cursor:
+            filters.append(MediaFile.id < cursor)
+        return await MediaFile.find(*filters).sort(-MediaFile.id).limit(limit).project(MediaFileSummary).to_list()
     
     @staticmethod
     async def create_user_session(user_id: PydanticObjectId, session_data: dict) -> UserSession:
@@ -63,27 +79,101 @@ class UserService:
         return resource is not None
     
     @staticmethod
-    async def get_user_preferences(user_id: PydanticObjectId) -> Optional[UserPreferences]:
-        """Get user preferences"""
-        preferences = await UserPreferences.find_one(UserPreferences.user_id == user_id)
-        if not preferences:
-            # Create default preferences if none exist
-            preferences = UserPreferences(user_id=user_id)
-            await preferences.insert()
-        return preferences
+    async def get_owned_session(user_id: PydanticObjectId, session_id: PydanticObjectId) -> Optional[UserSession]:
+        """Get session by ID if it belongs to the user, in a single query"""
+        return await UserSession.find_one(
+            UserSession.id == session_id,
+            UserSession.user_id == user_id
+        )
     
     @staticmethod
-    async def update_user_preferences(user_id: PydanticObjectId, preferences_data: dict) -> UserPreferences:
-        """Update user preferences"""
-        preferences = await UserPreferences.find_one(UserPreferences.user_id == user_id)
-        if not preferences:
-            preferences = UserPreferences(user_id=user_id, **preferences_data)
-            await preferences.insert()
-        else:
-            for key, value in preferences_data.items():
-                if hasattr(preferences, key):
-                    setattr(preferences, key, value)
-            preferences.updated_at = datetime.utcnow()
-            await preferences.save()
+    async def get_owned_media(user_id: PydanticObjectId, file_id: PydanticObjectId) -> Optional[MediaFile]:
+        """Get media file by ID if it belongs to the user, in a single query"""
+        return await MediaFile.find_one(
+            MediaFile.id == file_id,
+            MediaFile.user_id == user_id
+        )
+    
+    @staticmethod
+    async def get_media_by_sha256(user_id: PydanticObjectId, sha256: str) -> Optional[MediaFile]:
+        """Get a media file of the user's with the given content hash"""
+        return await MediaFile.find_one(
+            MediaFile.user_id == user_id,
+            MediaFile.sha256 == sha256
+        )
+    
+    @staticmethod
+    async def get_media_by_path(user_id: PydanticObjectId, file_path: str) -> Optional[MediaFile]:
+        """Get a media file of the user's stored at the given path"""
+        return await MediaFile.find_one(
+            MediaFile.user_id == user_id,
+            MediaFile.file_path == file_path
+        )
+    
+    @staticmethod
+    async def _upsert_preferences(user_id: PydanticObjectId, update: dict) -> UserPreferences:
+        """Apply an upsert to the user's preferences document and return the result"""
+        collection = UserPreferences.get_motor_collection()
+        try:
+            document = await collection.find_one_and_update(
+                {"user_id": user_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert inserted first; the document exists now, so the retry updates it
+            document = await collection.find_one_and_update(
+                {"user_id": user_id}, update, upsert=True, return_document=ReturnDocument.AFTER
+            )
+        return UserPreferences.model_validate(document)
+    
+    @staticmethod
+    async def get_user_preferences(user_id: PydanticObjectId) -> UserPreferences:
+        """Get user preferences, creating the defaults if none exist, in one atomic upsert"""
+        now = utc_now()
+        defaults = UserPreferences(user_id=user_id, created_at=now, updated_at=now)
+        return await UserService._upsert_preferences(
+            user_id, {"$setOnInsert": get_dict(defaults, to_db=True)}
+        )
+    
+    @staticmethod
+    async def get_user_with_preferences(user_id: PydanticObjectId) -> Optional[Tuple[UserDB, UserPreferences]]:
+        """Get user and their preferences in one round trip using $lookup"""
+        results = await UserDB.aggregate([
+            {"$match": {"_id": user_id}},
+            {"$lookup": {
+                "from": UserPreferences.Settings.name,
+                "localField": "_id",
+                "foreignField": "user_id",
+                "as": "prefs"
+            }},
+            {"$unwind": {"path": "$prefs", "preserveNullAndEmptyArrays": True}},
+            {"$limit": 1},
+        ]).to_list()
+        if not results:
+            return None
         
-        return preferences
\ No newline at end of file
+        prefs = results[0].pop("prefs", None)
+        user = UserDB.model_validate(results[0])
+        if prefs:
+            preferences = UserPreferences.model_validate(prefs)
+        else:
+            preferences = await UserService.get_user_preferences(user_id)
+        return user, preferences
+    
+    @staticmethod
+    async def update_user_preferences(user_id: PydanticObjectId, preferences_data: dict) -> UserPreferences:
+        """Update user preferences, creating the document if needed, in one atomic upsert"""
+        protected = {"id", "user_id", "created_at", "updated_at"}
+        fields = {
+            key: value for key, value in preferences_data.items()
+            if key in UserPreferences.model_fields and key not in protected
+        }
+        now = utc_now()
+        document = get_dict(
+            UserPreferences(user_id=user_id, created_at=now, updated_at=now, **fields), to_db=True
+        )
+        changes = {key: document[key] for key in fields}
+        changes["updated_at"] = now
+        return await UserService._upsert_preferences(user_id, {
+            "$set": changes,
+            "$setOnInsert": {key: value for key, value in document.items() if key not in changes},
+        })
\ No newline at end of file